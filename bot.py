@@ -12,9 +12,35 @@ from utils.log import setup_logger
 os.makedirs('logs', exist_ok=True)
 logger = setup_logger()
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    # discord.py already prefers orjson for gateway payloads when it is
+    # installed; llama_index's simple kvstore does not, and it serializes the
+    # whole docstore/index as one JSON blob on every persist. Point its json
+    # module at orjson.
+    import llama_index.core.storage.kvstore.simple_kvstore as _simple_kvstore
+
+    class _OrjsonShim:
+        dumps = staticmethod(lambda obj, **kwargs: orjson.dumps(obj).decode())
+        loads = staticmethod(orjson.loads)
+        load = staticmethod(lambda fp: orjson.loads(fp.read()))
+
+    _simple_kvstore.json = _OrjsonShim
+
 class DiscOllama(commands.Bot):
     def __init__(self):        
-        intents = discord.Intents.all()
+        # Only messages and threads are needed; members/presences/typing
+        # would stream events we never read.
+        intents = discord.Intents.default()
+        intents.message_content = True
+        intents.guilds = True
+        intents.members = False
+        intents.presences = False
+        intents.typing = False
         super().__init__(command_prefix='!', intents=intents)
 
     async def setup_hook(self):
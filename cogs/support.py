@@ -1,11 +1,14 @@
+import asyncio
+import time
+
 import discord
 from discord import app_commands
 from discord.ext import commands
 from utils.log import setup_logger
 from utils.rag import RAGChatPipeline
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy.orm import declarative_base
 from datetime import datetime
 
 logger = setup_logger()
@@ -19,13 +22,80 @@ class SupportTicket(Base):
     user_id = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+# How long a "this thread is not a ticket" result stays cached before we
+# ask the database again, and how many entries to hold before pruning.
+NEGATIVE_CACHE_TTL = 300.0
+NEGATIVE_CACHE_MAX = 1024
+
+# Discord caps messages at 2000 characters and channels at roughly
+# 5 sends per 5 seconds; the semaphore keeps bursts under that.
+MESSAGE_CHAR_LIMIT = 2000
+SEND_CONCURRENCY = 4
+ERROR_DEDUP_WINDOW = 10.0
+
+# Minimum gap between streaming edits, staying under Discord's
+# 5-edits-per-5-seconds limit per message.
+STREAM_EDIT_INTERVAL = 0.5
+
 class Support(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.rag = RAGChatPipeline()
-        self.engine = create_engine('sqlite:///database.db')
-        Base.metadata.create_all(self.engine)
-        self.Session = sessionmaker(bind=self.engine)
+        self.rag = None
+        self.engine = None
+        self.Session = None
+        self.ticket_owners = {}
+        self.non_tickets = {}
+        self._rag_ready = asyncio.Event()
+        self._rag_task = None
+        self._send_semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+        self._recent_errors = {}
+
+    async def _send(self, channel, content=None, *, embed=None):
+        chunks = (
+            [content[i:i + MESSAGE_CHAR_LIMIT] for i in range(0, len(content), MESSAGE_CHAR_LIMIT)]
+            if content and len(content) > MESSAGE_CHAR_LIMIT
+            else [content]
+        )
+        for chunk in chunks:
+            async with self._send_semaphore:
+                while True:
+                    try:
+                        await channel.send(content=chunk, embed=embed)
+                        break
+                    except discord.HTTPException as e:
+                        if e.status == 429:
+                            await asyncio.sleep(getattr(e, "retry_after", None) or 1.0)
+                            continue
+                        raise
+            embed = None
+
+    async def cog_load(self):
+        # Building the pipeline loads the index and opens Ollama clients;
+        # run it in the background so the READY handshake isn't delayed.
+        self._rag_task = asyncio.create_task(self._init_rag())
+
+    async def _init_rag(self):
+        def build():
+            rag = RAGChatPipeline()
+            Base.metadata.create_all(rag.engine)
+            with rag.Session() as session:
+                owners = {
+                    ticket.thread_id: ticket.user_id
+                    for ticket in session.query(SupportTicket).all()
+                }
+            return rag, owners
+
+        try:
+            self.rag, self.ticket_owners = await asyncio.to_thread(build)
+            self.engine = self.rag.engine
+            self.Session = self.rag.Session
+            logger.info("RAG pipeline initialized")
+        except Exception as e:
+            logger.error(f"Failed to initialize RAG pipeline: {str(e)}")
+        finally:
+            # Always release waiters; handlers check self.rag to tell a
+            # failed init apart from a successful one.
+            self._rag_ready.set()
 
     @app_commands.command(name="ping", description="Check bot latency")
     async def ping(self, interaction: discord.Interaction):
@@ -37,6 +107,11 @@ class Support(commands.Cog):
     @app_commands.command(name="support", description="Create a support ticket")
     async def create_ticket(self, interaction: discord.Interaction):
         try:
+            await self._rag_ready.wait()
+            if self.rag is None:
+                await interaction.response.send_message("The support assistant is currently unavailable. Please try again later or contact an administrator.", ephemeral=True)
+                return
+
             thread = await interaction.channel.create_thread(
                 name=f"Support: {interaction.user.name}",
                 type=discord.ChannelType.private_thread,
@@ -52,7 +127,7 @@ class Support(commands.Cog):
             welcome_embed.add_field(name="Instructions", value="Describe your issue clearly, and the AI will respond to your messages.", inline=False)
             welcome_embed.set_footer(text="Our AI assistant will do its best to provide support.")
 
-            await thread.send(embed=welcome_embed)
+            await self._send(thread, embed=welcome_embed)
             await interaction.response.send_message(f"Support ticket created in {thread.mention}", ephemeral=True)
 
             with self.Session() as session:
@@ -60,6 +135,9 @@ class Support(commands.Cog):
                 session.add(new_ticket)
                 session.commit()
 
+            self.ticket_owners[str(thread.id)] = str(interaction.user.id)
+            self.non_tickets.pop(str(thread.id), None)
+
             logger.info(f"Support ticket created by {interaction.user.name} (ID: {interaction.user.id}) in channel {thread.name} (ID: {thread.id})")
 
         except discord.errors.Forbidden:
@@ -79,23 +157,98 @@ class Support(commands.Cog):
 
         thread_id = str(message.channel.id)
 
-        with self.Session() as session:
-            ticket = session.query(SupportTicket).filter_by(thread_id=thread_id).first()
-            if not ticket or str(message.author.id) != ticket.user_id:
+        await self._rag_ready.wait()
+        if self.rag is None:
+            # With the pipeline down we cannot tell tickets from ordinary
+            # threads, so stay silent rather than spam every thread the bot
+            # can see; /support reports the outage to users.
+            now = time.monotonic()
+            last_error = self._recent_errors.get(thread_id)
+            if last_error is None or now - last_error > ERROR_DEDUP_WINDOW:
+                self._recent_errors[thread_id] = now
+                logger.error(f"RAG pipeline unavailable; ignoring message in thread {thread_id}")
+            return
+
+        owner = self.ticket_owners.get(thread_id)
+        if owner is None:
+            expiry = self.non_tickets.get(thread_id)
+            if expiry is not None and expiry > time.monotonic():
+                return
+
+            def lookup_ticket():
+                with self.Session() as session:
+                    return session.query(SupportTicket).filter_by(thread_id=thread_id).first()
+
+            ticket = await asyncio.to_thread(lookup_ticket)
+            if ticket is None:
+                now = time.monotonic()
+                if len(self.non_tickets) >= NEGATIVE_CACHE_MAX:
+                    self.non_tickets = {
+                        tid: exp for tid, exp in self.non_tickets.items() if exp > now
+                    }
+                    while len(self.non_tickets) >= NEGATIVE_CACHE_MAX:
+                        self.non_tickets.pop(next(iter(self.non_tickets)))
+                self.non_tickets[thread_id] = now + NEGATIVE_CACHE_TTL
                 return
+            owner = ticket.user_id
+            self.ticket_owners[thread_id] = owner
+
+        if str(message.author.id) != owner:
+            return
 
         try:
+            # Exact repeats are answered straight from the response cache,
+            # before spending an embedding round-trip.
+            cached = self.rag.cached_response(message.content, thread_id)
+            if cached is not None:
+                await self._send(message.channel, cached)
+                logger.info(f"Cached response sent in ticket {thread_id} for user {message.author.id}")
+                return
+            # Batched through the pipeline's EmbedBatcher so concurrent
+            # tickets share one embedding round-trip.
+            query_embedding = await self.rag.aembed(message.content)
+            stream = self.rag.stream_chat(message.content, thread_id, query_embedding=query_embedding)
+            reply = None
+            buffer = ""
+            last_edit = 0.0
             async with message.channel.typing():
-                response = self.rag.chat(message.content, thread_id)
-            await message.channel.send(response)
+                while True:
+                    token = await asyncio.to_thread(next, stream, None)
+                    if token is None:
+                        break
+                    buffer += token
+                    if len(buffer) > MESSAGE_CHAR_LIMIT:
+                        # Over the message limit: stop live-editing and send
+                        # the overflow as follow-up messages at the end.
+                        continue
+                    now = time.monotonic()
+                    if reply is None and buffer.strip():
+                        reply = await message.channel.send(buffer)
+                        last_edit = now
+                    elif reply is not None and now - last_edit >= STREAM_EDIT_INTERVAL:
+                        await reply.edit(content=buffer)
+                        last_edit = now
+            if reply is None:
+                if buffer:
+                    await self._send(message.channel, buffer)
+            else:
+                await reply.edit(content=buffer[:MESSAGE_CHAR_LIMIT])
+                if len(buffer) > MESSAGE_CHAR_LIMIT:
+                    await self._send(message.channel, buffer[MESSAGE_CHAR_LIMIT:])
             logger.info(f"RAG response sent in ticket {thread_id} for user {message.author.id}")
         except Exception as e:
             logger.error(f"Error generating RAG response in ticket {thread_id}: {str(e)}")
-            await message.channel.send("I apologize, but I encountered an error while processing your request. Please try again or contact a human administrator if the issue persists.")
+            now = time.monotonic()
+            last_error = self._recent_errors.get(thread_id)
+            if last_error is None or now - last_error > ERROR_DEDUP_WINDOW:
+                self._recent_errors[thread_id] = now
+                await self._send(message.channel, "I apologize, but I encountered an error while processing your request. Please try again or contact a human administrator if the issue persists.")
 
     def cog_unload(self):
-        self.rag.close()
-        self.engine.dispose()
+        if self._rag_task is not None:
+            self._rag_task.cancel()
+        if self.rag is not None:
+            self.rag.close()
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(Support(bot))
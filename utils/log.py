@@ -1,17 +1,33 @@
+import atexit
 import logging
+import os
+import queue
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener
 
 def setup_logger():
     logger = logging.getLogger(__name__)
+    # Cogs call setup_logger() too; without this guard each call re-adds
+    # handlers and every line gets written once per caller.
+    if logger.handlers:
+        return logger
     logger.setLevel(logging.INFO)
 
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
+    os.makedirs('logs', exist_ok=True)
     file_handler = logging.FileHandler('logs/bot.log')
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    buffered_handler = MemoryHandler(capacity=1024, flushLevel=logging.ERROR, target=file_handler)
 
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
 
-    return logger
\ No newline at end of file
+    # Handlers run on the listener thread, so logging from the event loop is
+    # just a queue put instead of a blocking write().
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, buffered_handler, console_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    return logger
@@ -1,11 +1,23 @@
 import os
-from typing import List, Union, Dict
+import json
+import time
+import queue
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import List, Union, Dict, Optional
 from pathlib import Path
 from datetime import datetime
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text
+import faiss
+import numpy as np
+
+from sqlalchemy import create_engine, event, Column, Index, Integer, String, DateTime, Text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
 
 from llama_index.core import (
     VectorStoreIndex,
@@ -18,38 +30,602 @@ from llama_index.core import (
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.llms.ollama import Ollama
 from llama_index.embeddings.ollama import OllamaEmbedding
+from llama_index.core.base.llms.types import ChatMessage as LlamaChatMessage, MessageRole
 from llama_index.core.chat_engine import ContextChatEngine
+from llama_index.core.memory import BaseMemory
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
 from llama_index.readers.web import SimpleWebPageReader
+from llama_index.vector_stores.faiss import FaissVectorStore
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+from utils.log import setup_logger
+
+logger = setup_logger()
 
 Base = declarative_base()
 
+SYSTEM_PROMPT = (
+    "You are an AI assistant meticulously crafted to provide expert support for Ollama. "
+    "Your responses must strictly adhere to the following comprehensive guidelines:\n\n"
+    "1. Ollama-Centric Focus:\n"
+    "   - Concentrate exclusively on Ollama-related topics.\n"
+    "   - If a query diverges from Ollama, gently steer the conversation back to Ollama support.\n"
+    "   - Demonstrate deep knowledge of Ollama's features, architecture, and common use cases.\n\n"
+    "2. Clarification and Understanding:\n"
+    "   - Always begin by asking clarifying questions to fully grasp the user's issue or inquiry.\n"
+    "   - Paraphrase the user's question to confirm your understanding before proceeding.\n"
+    "   - If any aspect of the query is ambiguous, seek specific details to avoid misinterpretation.\n\n"
+    "3. Information Sources and Accuracy:\n"
+    "   - Base your responses solely on the provided context and your embedded knowledge about Ollama.\n"
+    "   - Do not introduce information from external sources or make assumptions.\n"
+    "   - If you lack information or are uncertain, clearly state this limitation.\n"
+    "   - Prioritize accuracy over completeness – it's better to provide partial, correct information than risk including inaccuracies.\n\n"
+    "4. Problem-Solving Approach:\n"
+    "   - Offer step-by-step instructions for processes or troubleshooting, ensuring each step is clear and actionable.\n"
+    "   - For complex issues, break down the solution into manageable phases or checkpoints.\n"
+    "   - Anticipate potential pitfalls in the solutions you provide and offer preemptive advice to avoid them.\n\n"
+    "5. Communication Style:\n"
+    "   - Use clear, concise language appropriate for both novices and experienced users.\n"
+    "   - When technical terms are necessary, provide brief, accessible explanations.\n"
+    "   - Maintain a tone that is professional, patient, and consistently helpful.\n"
+    "   - Use analogies or comparisons when they can simplify complex concepts.\n\n"
+    "6. Error Handling and Diagnostics:\n"
+    "   - For reported errors, always request the exact error message and relevant logs.\n"
+    "   - Guide users on how to locate and share necessary diagnostic information.\n"
+    "   - Explain the potential causes of common errors and their implications.\n\n"
+    "7. Resource Utilization:\n"
+    "   - Encourage users to consult Ollama's official documentation for the most current information.\n"
+    "   - Provide specific links or sections in the documentation when relevant.\n"
+    "   - Suggest Ollama's community forums or official support channels for issues beyond your scope.\n\n"
+    "8. Solution Presentation:\n"
+    "   - Summarize your understanding of the issue before presenting solutions.\n"
+    "   - When multiple solutions exist, present them in order of likelihood or simplicity.\n"
+    "   - Clearly explain the pros, cons, and potential impacts of each proposed solution.\n"
+    "   - Include any necessary precautions or preparatory steps before implementing solutions.\n\n"
+    "9. Continuous Engagement:\n"
+    "   - After providing a solution, always inquire if further clarification is needed.\n"
+    "   - Encourage users to test solutions and report back on the results.\n"
+    "   - Be prepared to troubleshoot if the initial solution doesn't fully resolve the issue.\n\n"
+    "10. Ethical Considerations:\n"
+    "    - Respect user privacy – never ask for or encourage sharing of sensitive information.\n"
+    "    - If a user's request involves potential misuse of Ollama, diplomatically redirect to appropriate use cases.\n"
+    "    - Promote best practices in AI ethics and responsible use of language models.\n\n"
+    "11. Feedback and Improvement:\n"
+    "    - Encourage users to provide feedback on the support experience.\n"
+    "    - If you encounter scenarios not covered in your knowledge base, suggest the user report this to Ollama's development team.\n\n"
+    "12. Version Awareness:\n"
+    "    - Always ask which version of Ollama the user is working with, as features and behaviors may vary.\n"
+    "    - Highlight any version-specific considerations in your responses.\n\n"
+    "13. Performance Optimization:\n"
+    "    - Provide tips on optimizing Ollama's performance, including hardware recommendations and configuration best practices.\n"
+    "    - Explain the trade-offs between model size, performance, and resource requirements.\n\n"
+    "14. Integration and Ecosystem:\n"
+    "    - Offer guidance on integrating Ollama with other tools and frameworks in the AI/ML ecosystem.\n"
+    "    - Explain Ollama's unique features and how they compare to or complement other language model solutions.\n\n"
+    "Remember, your ultimate goal is to provide exceptionally accurate and helpful support for Ollama, "
+    "ensuring user satisfaction while minimizing misinformation and confusion. Always strive to empower "
+    "users with knowledge and solutions that enhance their experience with Ollama."
+)
+
+# Engines rebuild cheaply from DB-backed memory, so evicting idle channels
+# only costs a re-instantiation on their next message.
+MAX_CHAT_ENGINES = 128
+
+# nomic-embed-text output dimensionality.
+EMBED_DIM = 768
+
+# Rough token count of SYSTEM_PROMPT (~4 chars/token). Passed as num_keep so
+# the server pins the shared prefix in its KV cache instead of re-prefilling
+# it on every turn.
+SYSTEM_PROMPT_TOKENS = len(SYSTEM_PROMPT) // 4
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+class CachedOllamaEmbedding(OllamaEmbedding):
+    _cache_conn: sqlite3.Connection = PrivateAttr()
+    _cache_lock: threading.Lock = PrivateAttr()
+    _query_cache: "OrderedDict[str, List[float]]" = PrivateAttr()
+    _query_cache_size: int = PrivateAttr()
+
+    def __init__(
+        self,
+        *args,
+        cache_path: Union[str, Path] = "./embed_cache.db",
+        query_cache_size: int = 1024,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self._cache_conn = sqlite3.connect(str(cache_path), check_same_thread=False)
+        self._cache_conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, vec BLOB)"
+        )
+        self._cache_conn.commit()
+        self._cache_lock = threading.Lock()
+        # Queries are one-off user messages, so they get a bounded in-memory
+        # LRU rather than rows in the sqlite cache, which is reserved for
+        # document chunks that recur across restarts.
+        self._query_cache = OrderedDict()
+        self._query_cache_size = query_cache_size
+
+    def _cache_key(self, text: str) -> str:
+        return hashlib.sha256(self.model_name.encode() + b"\x00" + text.encode()).hexdigest()
+
+    def _cache_get(self, text: str) -> Optional[List[float]]:
+        with self._cache_lock:
+            row = self._cache_conn.execute(
+                "SELECT vec FROM embeddings WHERE hash = ?", (self._cache_key(text),)
+            ).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    def _cache_put(self, pairs: List[tuple]) -> None:
+        rows = [
+            (self._cache_key(text), np.asarray(embedding, dtype=np.float32).tobytes())
+            for text, embedding in pairs
+        ]
+        with self._cache_lock:
+            self._cache_conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (hash, vec) VALUES (?, ?)", rows
+            )
+            self._cache_conn.commit()
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        cached = self._cache_get(text)
+        if cached is not None:
+            return cached
+        embedding = super()._get_text_embedding(text)
+        self._cache_put([(text, embedding)])
+        return embedding
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        results: List[Optional[List[float]]] = [self._cache_get(text) for text in texts]
+        misses = [i for i, result in enumerate(results) if result is None]
+        if misses:
+            fresh = super()._get_text_embeddings([texts[i] for i in misses])
+            for i, embedding in zip(misses, fresh):
+                results[i] = embedding
+            self._cache_put([(texts[i], embedding) for i, embedding in zip(misses, fresh)])
+        return results
+
+    def _query_cache_get(self, query: str) -> Optional[List[float]]:
+        with self._cache_lock:
+            embedding = self._query_cache.get(query)
+            if embedding is not None:
+                self._query_cache.move_to_end(query)
+            return embedding
+
+    def _query_cache_put(self, query: str, embedding: List[float]) -> None:
+        with self._cache_lock:
+            self._query_cache[query] = embedding
+            self._query_cache.move_to_end(query)
+            while len(self._query_cache) > self._query_cache_size:
+                self._query_cache.popitem(last=False)
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        # The retriever embeds the query it is handed, so sharing this cache
+        # with embed_queries makes its call free when the pipeline already
+        # embedded the same message.
+        cached = self._query_cache_get(query)
+        if cached is not None:
+            return cached
+        embedding = super()._get_query_embedding(query)
+        self._query_cache_put(query, embedding)
+        return embedding
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        results: List[Optional[List[float]]] = [self._query_cache_get(query) for query in queries]
+        misses = [i for i, result in enumerate(results) if result is None]
+        if misses:
+            fresh = self.get_general_text_embeddings(
+                [self._format_query(queries[i]) for i in misses]
+            )
+            for i, embedding in zip(misses, fresh):
+                results[i] = embedding
+                self._query_cache_put(queries[i], embedding)
+        return results
+
 class ChatMessage(Base):
     __tablename__ = 'chat_messages'
-    
+    # Composite index so get_messages is a pure range scan instead of an
+    # index lookup followed by a temp-B-tree sort on timestamp.
+    __table_args__ = (Index('ix_chat_messages_channel_ts', 'channel_id', 'timestamp'),)
+
     id = Column(Integer, primary_key=True)
-    channel_id = Column(String, index=True)
+    channel_id = Column(String)
     role = Column(String)
     content = Column(Text)
     timestamp = Column(DateTime, default=datetime.utcnow)
 
-class DatabaseChatMemory:
-    def __init__(self, session: Session, channel_id: str, token_limit: int):
-        self.session = session
-        self.channel_id = channel_id
-        self.token_limit = token_limit
+class ChatMessageWriter:
+    def __init__(self, session_factory, flush_interval: float = 0.2, max_batch: int = 32):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue: "queue.SimpleQueue[ChatMessage]" = queue.SimpleQueue()
+        self._stop = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def enqueue(self, message: ChatMessage) -> None:
+        self._queue.put(message)
+
+    def _drain(self, block: bool) -> List[ChatMessage]:
+        batch: List[ChatMessage] = []
+        try:
+            batch.append(self._queue.get(block=block, timeout=self.flush_interval))
+            while len(batch) < self.max_batch:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            batch = self._drain(block=True)
+            if batch and not self._flush(batch):
+                # Batch went back on the queue; wait before retrying so a
+                # down database isn't hammered in a tight loop.
+                self._stop.wait(self.flush_interval)
+
+    def _flush(self, batch: List[ChatMessage]) -> bool:
+        with self._flush_lock:
+            session = self.session_factory()
+            try:
+                session.bulk_save_objects(batch)
+                session.commit()
+                return True
+            except Exception as e:
+                session.rollback()
+                logger.error(f"Failed to flush {len(batch)} chat messages, re-queueing: {str(e)}")
+                for message in batch:
+                    self._queue.put(message)
+                return False
+            finally:
+                session.close()
+
+    def flush(self) -> None:
+        # A batch the writer thread already drained is invisible to the loop
+        # below; taking the lock waits out that in-flight commit so callers
+        # get read-your-writes even when the queue drains empty.
+        with self._flush_lock:
+            pass
+        while True:
+            batch = self._drain(block=False)
+            if not batch:
+                return
+            if not self._flush(batch):
+                # The batch was re-queued; retrying here would spin.
+                return
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join(timeout=5.0)
+        self.flush()
+
+class DatabaseChatMemory(BaseMemory):
+    # llama_index's BaseMemory interface over the chat_messages table, so
+    # ContextChatEngine reads and writes history through the write-behind
+    # queue instead of keeping it in process memory.
+    channel_id: str
+    token_limit: int
+
+    _session_factory = PrivateAttr()
+    _writer: ChatMessageWriter = PrivateAttr()
+
+    def __init__(self, session_factory, channel_id: str, token_limit: int, writer: ChatMessageWriter):
+        # A factory, not a Session: engines are built and used on arbitrary
+        # worker threads, so each operation opens and closes its own session
+        # rather than pinning one thread's session for the engine's lifetime.
+        super().__init__(channel_id=channel_id, token_limit=token_limit)
+        self._session_factory = session_factory
+        self._writer = writer
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "DatabaseChatMemory"
+
+    @classmethod
+    def from_defaults(cls, **kwargs) -> "DatabaseChatMemory":
+        raise NotImplementedError(
+            "DatabaseChatMemory is constructed directly with a session factory and writer"
+        )
+
+    def put(self, message: LlamaChatMessage) -> None:
+        # Timestamp is set here rather than at INSERT time so delayed flushes
+        # keep the original message order. Streaming engines call put from a
+        # worker thread; enqueue is thread-safe.
+        self._writer.enqueue(
+            ChatMessage(
+                channel_id=self.channel_id,
+                role=message.role.value,
+                content=message.content or "",
+                timestamp=datetime.utcnow(),
+            )
+        )
+
+    def get(self, input: Optional[str] = None, **kwargs) -> List[LlamaChatMessage]:
+        # Read-your-writes: push any queued rows to the database first.
+        self._writer.flush()
+        # Fetch newest-first with a token-limit-derived row cap, then reverse
+        # back to chronological order, so per-turn I/O stays bounded no
+        # matter how long the ticket runs.
+        row_cap = max(32, self.token_limit // 128)
+        with self._session_factory() as session:
+            rows = (
+                session.query(ChatMessage)
+                .filter_by(channel_id=self.channel_id)
+                .order_by(ChatMessage.timestamp.desc())
+                .limit(row_cap)
+                .all()
+            )
+        return [
+            LlamaChatMessage(role=MessageRole(row.role), content=row.content)
+            for row in reversed(rows)
+        ]
+
+    def get_all(self) -> List[LlamaChatMessage]:
+        self._writer.flush()
+        with self._session_factory() as session:
+            rows = (
+                session.query(ChatMessage)
+                .filter_by(channel_id=self.channel_id)
+                .order_by(ChatMessage.timestamp)
+                .all()
+            )
+        return [LlamaChatMessage(role=MessageRole(row.role), content=row.content) for row in rows]
+
+    def set(self, messages: List[LlamaChatMessage]) -> None:
+        self.reset()
+        for message in messages:
+            self.put(message)
+
+    def reset(self) -> None:
+        self._writer.flush()
+        with self._session_factory() as session:
+            session.query(ChatMessage).filter_by(channel_id=self.channel_id).delete()
+            session.commit()
+
+class ResponseCache:
+    def __init__(self, maxsize: int = 256, ttl: float = 3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def _key(channel_id: str, message: str) -> bytes:
+        return hashlib.sha256((channel_id + "\x00" + message).encode()).digest()
+
+    def get(self, channel_id: str, message: str) -> Optional[str]:
+        key = self._key(channel_id, message)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                _, response, stored_at = entry
+                if time.time() - stored_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return response
+                del self._entries[key]
+            self._misses += 1
+            return None
+
+    def put(self, channel_id: str, message: str, response: str) -> None:
+        key = self._key(channel_id, message)
+        with self._lock:
+            self._entries[key] = (channel_id, response, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate_channel(self, channel_id: str) -> None:
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry[0] == channel_id]
+            for key in stale:
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses, "size": len(self._entries)}
+
+class SemanticCache:
+    def __init__(
+        self,
+        threshold: float = 0.95,
+        maxsize: int = 1024,
+        persist_path: Union[str, Path, None] = None,
+        persist_every: int = 32,
+    ):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.persist_path = Path(persist_path) if persist_path else None
+        self.persist_every = persist_every
+        self._embeddings: List[np.ndarray] = []
+        self._responses: List[str] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+        self._since_persist = 0
+        if self.persist_path and self.persist_path.exists():
+            self._load()
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def lookup(self, embedding: List[float]) -> Optional[str]:
+        vec = self._normalize(embedding)
+        with self._lock:
+            if not self._embeddings:
+                return None
+            # At maxsize 1024 x 768 float32 the full dot product is ~1.5
+            # MFLOPs through BLAS — microseconds, no pruning needed.
+            if self._matrix is None:
+                self._matrix = np.stack(self._embeddings)
+            scores = self._matrix @ vec
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                return self._responses[best]
+            return None
+
+    def put(self, embedding: List[float], response: str) -> None:
+        vec = self._normalize(embedding)
+        with self._lock:
+            if len(self._embeddings) >= self.maxsize:
+                self._embeddings.pop(0)
+                self._responses.pop(0)
+            self._embeddings.append(vec)
+            self._responses.append(response)
+            self._matrix = None
+            self._since_persist += 1
+            if self.persist_path and self._since_persist >= self.persist_every:
+                self._persist()
+
+    def _persist(self) -> None:
+        if not self._embeddings:
+            return
+        self.persist_path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            self.persist_path,
+            embeddings=np.stack(self._embeddings),
+            responses=np.array(self._responses, dtype=object),
+        )
+        self._since_persist = 0
+
+    def _load(self) -> None:
+        data = np.load(self.persist_path, allow_pickle=True)
+        self._embeddings = [vec for vec in data["embeddings"].astype(np.float32)]
+        self._responses = [str(resp) for resp in data["responses"]]
+        self._matrix = None
+
+    def flush(self) -> None:
+        with self._lock:
+            if self.persist_path:
+                self._persist()
 
-    def add_message(self, role: str, content: str):
-        message = ChatMessage(channel_id=self.channel_id, role=role, content=content)
-        self.session.add(message)
-        self.session.commit()
+# Client singletons: each Ollama/OllamaEmbedding instance owns its own HTTP
+# connection pool, so sharing one per model keeps TCP connections warm across
+# cog reloads, and keep_alive stops the server unloading the model between
+# requests.
+_llm_clients: Dict[str, Ollama] = {}
+_embed_model: Optional["CachedOllamaEmbedding"] = None
 
-    def get_messages(self):
-        messages = self.session.query(ChatMessage).filter_by(channel_id=self.channel_id).order_by(ChatMessage.timestamp).all()
-        return [{"role": msg.role, "content": msg.content} for msg in messages]
+def _get_llm(model_name: str) -> Ollama:
+    llm = _llm_clients.get(model_name)
+    if llm is None:
+        llm = Ollama(
+            model=model_name,
+            request_timeout=120.0,
+            keep_alive="30m",
+            additional_kwargs={
+                "cache_prompt": True,
+                "num_keep": SYSTEM_PROMPT_TOKENS,
+            },
+        )
+        _llm_clients[model_name] = llm
+    return llm
 
-    def clear(self):
-        self.session.query(ChatMessage).filter_by(channel_id=self.channel_id).delete()
-        self.session.commit()
+def _get_embed_model() -> "CachedOllamaEmbedding":
+    global _embed_model
+    if _embed_model is None:
+        _embed_model = CachedOllamaEmbedding(model_name="nomic-embed-text", keep_alive="30m")
+    return _embed_model
+
+class CachedRetriever(BaseRetriever):
+    def __init__(self, retriever: BaseRetriever, docstore, maxsize: int = 1024):
+        super().__init__()
+        self._retriever = retriever
+        self._docstore = docstore
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[bytes, List[tuple]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(query_str: str) -> bytes:
+        return hashlib.sha256(query_str.strip().lower().encode()).digest()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        key = self._key(query_bundle.query_str)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+        if cached is not None:
+            nodes = [self._docstore.get_node(node_id, raise_error=False) for node_id, _ in cached]
+            if all(node is not None for node in nodes):
+                return [
+                    NodeWithScore(node=node, score=score)
+                    for node, (_, score) in zip(nodes, cached)
+                ]
+        results = self._retriever.retrieve(query_bundle)
+        with self._lock:
+            self._entries[key] = [(result.node.node_id, result.score) for result in results]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return results
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+class EmbedBatcher:
+    def __init__(self, embedding_model: "CachedOllamaEmbedding", max_batch: int = 32, max_wait: float = 0.005):
+        self.embedding_model = embedding_model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def embed(self, text: str) -> List[float]:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            # Coalesce whatever else arrives within the window so one Ollama
+            # round-trip serves the whole burst.
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=self.max_wait))
+                except asyncio.TimeoutError:
+                    break
+            texts = [text for text, _ in batch]
+            try:
+                # Queries, not documents: routes through the query-formatted
+                # path and its in-memory LRU instead of the sqlite cache.
+                embeddings = await asyncio.to_thread(self.embedding_model.embed_queries, texts)
+            except Exception as exc:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+
+    def stop(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+            self._queue = None
 
 class RAGChatPipeline:
     def __init__(
@@ -59,103 +635,139 @@ class RAGChatPipeline:
         token_limit: int = 16_384,
         db_url: str = "sqlite:///database.db"
     ):
-        self.llm = Ollama(model=model_name)
-        self.embedding_model = OllamaEmbedding(model_name="nomic-embed-text")
+        self.llm = _get_llm(model_name)
+        self.embedding_model = _get_embed_model()
         self.persist_dir = Path(persist_dir)
         self.index = self._load_or_create_index()
         self.token_limit = token_limit
-        self.engine = create_engine(db_url)
+        self.engine = create_engine(
+            db_url,
+            poolclass=QueuePool,
+            pool_size=5,
+            max_overflow=10,
+            connect_args={"check_same_thread": False},
+        )
+        event.listens_for(self.engine, "connect")(_set_sqlite_pragmas)
         Base.metadata.create_all(self.engine)
-        self.Session = sessionmaker(bind=self.engine)
-        self.chat_engines: Dict[str, ContextChatEngine] = {}
+        # create_all skips tables that already exist, so databases created
+        # before the composite (channel_id, timestamp) index never get it;
+        # create it explicitly since there is no migration tooling.
+        for index in ChatMessage.__table__.indexes:
+            index.create(self.engine, checkfirst=True)
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
+        self.message_writer = ChatMessageWriter(self.Session)
+        self.chat_engines: "OrderedDict[str, ContextChatEngine]" = OrderedDict()
+        self.response_cache = ResponseCache()
+        self.semantic_cache = SemanticCache(persist_path=self.persist_dir / "semantic_cache.npz")
+        self.embed_batcher = EmbedBatcher(self.embedding_model)
+        self.retriever = CachedRetriever(self.index.as_retriever(), self.index.docstore)
 
     def _load_or_create_index(self) -> VectorStoreIndex:
         Settings.llm = self.llm
         Settings.embed_model = self.embedding_model
         Settings.node_parser = SentenceSplitter(chunk_size=1024, chunk_overlap=20)
 
-        if self.persist_dir.exists():
-            storage_context = StorageContext.from_defaults(persist_dir=str(self.persist_dir))
+        # The semantic cache and kv/ warm manifest also live under
+        # persist_dir, so the directory existing does not mean an index was
+        # ever persisted; check for the vector-store file itself.
+        if (self.persist_dir / "default__vector_store.json").exists():
+            vector_store = FaissVectorStore.from_persist_dir(str(self.persist_dir))
+            # quantize_index() may have persisted a PQ index, which has no
+            # HNSW parameters to tune.
+            if isinstance(vector_store.client, faiss.IndexHNSW):
+                vector_store.client.hnsw.efSearch = 64
+            storage_context = StorageContext.from_defaults(
+                vector_store=vector_store, persist_dir=str(self.persist_dir)
+            )
             return load_index_from_storage(storage_context)
-        return VectorStoreIndex([])
+
+        faiss_index = faiss.IndexHNSWFlat(EMBED_DIM, 32)
+        faiss_index.hnsw.efConstruction = 200
+        faiss_index.hnsw.efSearch = 64
+        storage_context = StorageContext.from_defaults(
+            vector_store=FaissVectorStore(faiss_index=faiss_index)
+        )
+        return VectorStoreIndex([], storage_context=storage_context)
 
     def _get_or_create_chat_engine(self, channel_id: str) -> ContextChatEngine:
-        if channel_id not in self.chat_engines:
-            session = self.Session()
-            memory = DatabaseChatMemory(session, channel_id, self.token_limit)
-            self.chat_engines[channel_id] = ContextChatEngine.from_defaults(
-                retriever=self.index.as_retriever(),
-                chat_memory=memory,
-                system_prompt=(
-                    "You are an AI assistant meticulously crafted to provide expert support for Ollama. "
-                    "Your responses must strictly adhere to the following comprehensive guidelines:\n\n"
-                    "1. Ollama-Centric Focus:\n"
-                    "   - Concentrate exclusively on Ollama-related topics.\n"
-                    "   - If a query diverges from Ollama, gently steer the conversation back to Ollama support.\n"
-                    "   - Demonstrate deep knowledge of Ollama's features, architecture, and common use cases.\n\n"
-                    "2. Clarification and Understanding:\n"
-                    "   - Always begin by asking clarifying questions to fully grasp the user's issue or inquiry.\n"
-                    "   - Paraphrase the user's question to confirm your understanding before proceeding.\n"
-                    "   - If any aspect of the query is ambiguous, seek specific details to avoid misinterpretation.\n\n"
-                    "3. Information Sources and Accuracy:\n"
-                    "   - Base your responses solely on the provided context and your embedded knowledge about Ollama.\n"
-                    "   - Do not introduce information from external sources or make assumptions.\n"
-                    "   - If you lack information or are uncertain, clearly state this limitation.\n"
-                    "   - Prioritize accuracy over completeness – it's better to provide partial, correct information than risk including inaccuracies.\n\n"
-                    "4. Problem-Solving Approach:\n"
-                    "   - Offer step-by-step instructions for processes or troubleshooting, ensuring each step is clear and actionable.\n"
-                    "   - For complex issues, break down the solution into manageable phases or checkpoints.\n"
-                    "   - Anticipate potential pitfalls in the solutions you provide and offer preemptive advice to avoid them.\n\n"
-                    "5. Communication Style:\n"
-                    "   - Use clear, concise language appropriate for both novices and experienced users.\n"
-                    "   - When technical terms are necessary, provide brief, accessible explanations.\n"
-                    "   - Maintain a tone that is professional, patient, and consistently helpful.\n"
-                    "   - Use analogies or comparisons when they can simplify complex concepts.\n\n"
-                    "6. Error Handling and Diagnostics:\n"
-                    "   - For reported errors, always request the exact error message and relevant logs.\n"
-                    "   - Guide users on how to locate and share necessary diagnostic information.\n"
-                    "   - Explain the potential causes of common errors and their implications.\n\n"
-                    "7. Resource Utilization:\n"
-                    "   - Encourage users to consult Ollama's official documentation for the most current information.\n"
-                    "   - Provide specific links or sections in the documentation when relevant.\n"
-                    "   - Suggest Ollama's community forums or official support channels for issues beyond your scope.\n\n"
-                    "8. Solution Presentation:\n"
-                    "   - Summarize your understanding of the issue before presenting solutions.\n"
-                    "   - When multiple solutions exist, present them in order of likelihood or simplicity.\n"
-                    "   - Clearly explain the pros, cons, and potential impacts of each proposed solution.\n"
-                    "   - Include any necessary precautions or preparatory steps before implementing solutions.\n\n"
-                    "9. Continuous Engagement:\n"
-                    "   - After providing a solution, always inquire if further clarification is needed.\n"
-                    "   - Encourage users to test solutions and report back on the results.\n"
-                    "   - Be prepared to troubleshoot if the initial solution doesn't fully resolve the issue.\n\n"
-                    "10. Ethical Considerations:\n"
-                    "    - Respect user privacy – never ask for or encourage sharing of sensitive information.\n"
-                    "    - If a user's request involves potential misuse of Ollama, diplomatically redirect to appropriate use cases.\n"
-                    "    - Promote best practices in AI ethics and responsible use of language models.\n\n"
-                    "11. Feedback and Improvement:\n"
-                    "    - Encourage users to provide feedback on the support experience.\n"
-                    "    - If you encounter scenarios not covered in your knowledge base, suggest the user report this to Ollama's development team.\n\n"
-                    "12. Version Awareness:\n"
-                    "    - Always ask which version of Ollama the user is working with, as features and behaviors may vary.\n"
-                    "    - Highlight any version-specific considerations in your responses.\n\n"
-                    "13. Performance Optimization:\n"
-                    "    - Provide tips on optimizing Ollama's performance, including hardware recommendations and configuration best practices.\n"
-                    "    - Explain the trade-offs between model size, performance, and resource requirements.\n\n"
-                    "14. Integration and Ecosystem:\n"
-                    "    - Offer guidance on integrating Ollama with other tools and frameworks in the AI/ML ecosystem.\n"
-                    "    - Explain Ollama's unique features and how they compare to or complement other language model solutions.\n\n"
-                    "Remember, your ultimate goal is to provide exceptionally accurate and helpful support for Ollama, "
-                    "ensuring user satisfaction while minimizing misinformation and confusion. Always strive to empower "
-                    "users with knowledge and solutions that enhance their experience with Ollama."
+        engine = self.chat_engines.get(channel_id)
+        if engine is None:
+            memory = DatabaseChatMemory(self.Session, channel_id, self.token_limit, self.message_writer)
+            engine = ContextChatEngine.from_defaults(
+                retriever=self.retriever,
+                memory=memory,
+                system_prompt=SYSTEM_PROMPT,
+            )
+            self.chat_engines[channel_id] = engine
+            while len(self.chat_engines) > MAX_CHAT_ENGINES:
+                self.chat_engines.popitem(last=False)
+        self.chat_engines.move_to_end(channel_id)
+        return engine
+
+    def _process_and_index_documents(self, documents: List[Document], batch_size: int = 64) -> None:
+        nodes = Settings.node_parser.get_nodes_from_documents(documents)
+        texts = [node.get_content(metadata_mode="embed") for node in nodes]
+        embeddings: List[List[float]] = []
+        for start in range(0, len(texts), batch_size):
+            embeddings.extend(
+                self.embedding_model.get_text_embedding_batch(
+                    texts[start:start + batch_size], show_progress=False
                 )
             )
-        return self.chat_engines[channel_id]
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+        self.index.insert_nodes(nodes)
+        self.retriever.clear()
+        self._warm_document_kv(nodes)
+        self.index.storage_context.persist(persist_dir=str(self.persist_dir))
 
-    def _process_and_index_documents(self, documents: List[Document]) -> None:
-        for doc in documents:
-            self.index.insert(doc)
+    def quantize_index(self, m: int = 48, nbits: int = 8) -> None:
+        # Maintenance step for large corpora: rebuild the FAISS index with
+        # product quantization so vectors are stored as int8 codes instead of
+        # float32, shrinking RAM ~16x and moving distance compute to SIMD
+        # table lookups. Call once after bulk ingestion; PQ training needs a
+        # reasonable sample, so small indexes are left as-is.
+        flat_index = self.index.vector_store.client
+        total = flat_index.ntotal
+        if total < 1024:
+            return
+        vectors = flat_index.reconstruct_n(0, total)
+        pq_index = faiss.IndexPQ(EMBED_DIM, m, nbits)
+        pq_index.train(vectors)
+        pq_index.add(vectors)
+        self.index.vector_store._faiss_index = pq_index
+        # Cached (node_id, score) pairs were computed against the flat index.
+        self.retriever.clear()
         self.index.storage_context.persist(persist_dir=str(self.persist_dir))
 
+    def _warm_document_kv(self, nodes) -> None:
+        # Ollama has no HTTP API for saving KV slots to disk, so the closest
+        # we get to precomputed chunk caches is prefilling each chunk through
+        # the server with cache_prompt so its KV state is hot before queries
+        # arrive. A manifest of content hashes skips chunks already warmed.
+        kv_dir = self.persist_dir / "kv"
+        kv_dir.mkdir(parents=True, exist_ok=True)
+        manifest_path = kv_dir / "warmed.json"
+        warmed: Dict[str, str] = {}
+        if manifest_path.exists():
+            warmed = json.loads(manifest_path.read_text())
+        for node in nodes:
+            content = node.get_content()
+            digest = hashlib.sha256(content.encode()).hexdigest()
+            if warmed.get(node.node_id) == digest:
+                continue
+            try:
+                self.llm.client.generate(
+                    model=self.llm.model,
+                    prompt=content,
+                    options={"num_predict": 0, "cache_prompt": True},
+                )
+            except Exception:
+                # Warming is best-effort; ingestion must not fail on it.
+                break
+            warmed[node.node_id] = digest
+        manifest_path.write_text(json.dumps(warmed))
+
     def load_local_directory(self, directory: Union[str, Path]) -> None:
         directory = Path(directory)
         if not directory.is_dir():
@@ -170,17 +782,67 @@ class RAGChatPipeline:
         documents = reader.load_data(urls=[url])
         self._process_and_index_documents(documents)
 
-    def chat(self, message: str, channel_id: str) -> str:
+    def cached_response(self, message: str, channel_id: str) -> Optional[str]:
+        # Exact-hit probe so callers can answer without paying for an
+        # embedding round-trip first.
+        return self.response_cache.get(channel_id, message)
+
+    def chat(self, message: str, channel_id: str, query_embedding: Optional[List[float]] = None) -> str:
+        cached = self.response_cache.get(channel_id, message)
+        if cached is not None:
+            return cached
+        if query_embedding is None:
+            query_embedding = self.embedding_model.get_query_embedding(message)
+        semantic_hit = self.semantic_cache.lookup(query_embedding)
+        if semantic_hit is not None:
+            self.response_cache.put(channel_id, message, semantic_hit)
+            return semantic_hit
         chat_engine = self._get_or_create_chat_engine(channel_id)
         response = chat_engine.chat(message)
+        self.response_cache.put(channel_id, message, response.response)
+        self.semantic_cache.put(query_embedding, response.response)
         return response.response
 
+    def stream_chat(self, message: str, channel_id: str, query_embedding: Optional[List[float]] = None):
+        # Yields response text deltas. Cache hits yield the full answer in
+        # one piece; misses stream from the engine and populate the caches
+        # once generation finishes.
+        cached = self.response_cache.get(channel_id, message)
+        if cached is not None:
+            yield cached
+            return
+        if query_embedding is None:
+            query_embedding = self.embedding_model.get_query_embedding(message)
+        semantic_hit = self.semantic_cache.lookup(query_embedding)
+        if semantic_hit is not None:
+            self.response_cache.put(channel_id, message, semantic_hit)
+            yield semantic_hit
+            return
+        chat_engine = self._get_or_create_chat_engine(channel_id)
+        response = chat_engine.stream_chat(message)
+        parts = []
+        for token in response.response_gen:
+            parts.append(token)
+            yield token
+        full_response = "".join(parts)
+        self.response_cache.put(channel_id, message, full_response)
+        self.semantic_cache.put(query_embedding, full_response)
+
+    async def aembed(self, text: str) -> List[float]:
+        return await self.embed_batcher.embed(text)
+
     def reset_chat(self, channel_id: str) -> None:
-        if channel_id in self.chat_engines:
-            self.chat_engines[channel_id].chat_memory.clear()
-            del self.chat_engines[channel_id]
+        self.response_cache.invalidate_channel(channel_id)
+        self.chat_engines.pop(channel_id, None)
+        # History lives in the database, not the engine, so wipe it there
+        # whether or not an engine is currently cached for the channel.
+        DatabaseChatMemory(self.Session, channel_id, self.token_limit, self.message_writer).reset()
 
     def close(self):
+        self.embed_batcher.stop()
+        self.message_writer.stop()
+        self.semantic_cache.flush()
+        self.Session.remove()
         self.engine.dispose()
 
 async def main():